@@ -9,6 +9,7 @@ import math
 import matplotlib.pyplot as plt
 import imageio
 import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 import robosuite as suite
 from robosuite.controllers import load_controller_config
@@ -73,12 +74,15 @@ def get_policy_action(obs=None):
 camera_rgb = camera_names + "_image"
 camera_depth = camera_names + "_depth"
 
-frames_rgb = [obs[camera_rgb]]
-depth_image = np.uint8(obs[camera_depth] * 255)
-frames_depth = [depth_image]
+# frames of the whole episode (reset frame + horizon steps), allocated once and written in place
+frames_rgb = np.empty((horizon + 1,) + obs[camera_rgb].shape, dtype=np.uint8)
+frames_depth = np.empty((horizon + 1,) + obs[camera_depth].shape, dtype=np.uint8)
+frames_rgb[0] = obs[camera_rgb]
+frames_depth[0] = obs[camera_depth] * 255
 
 done = False
 episode_reward = 0
+num_steps = 0
 start_time = time.time()
 while not done:
     action = get_policy_action()         # use observation to decide on an action
@@ -89,10 +93,9 @@ while not done:
 
     # print(obs["agentview_image"].min(), obs["agentview_image"].max())
     # print(obs[camera_depth].min(), obs[camera_depth].max())
-    frames_rgb.append(obs[camera_rgb])
-    depth_image = np.uint8(obs[camera_depth] * 255)
-    # print(np.min(depth_image), np.max(depth_image))
-    frames_depth.append(depth_image)
+    num_steps += 1
+    frames_rgb[num_steps] = obs[camera_rgb]
+    frames_depth[num_steps] = obs[camera_depth] * 255     # truncated to uint8 as it is stored
     
     # obs1 = np.flip(obs[:image_size*image_size*3].reshape(image_size, image_size, 3), axis=0)
     # obs1 = obs1.astype(np.uint8)
@@ -117,10 +120,14 @@ env.close()
 print("rollout completed with return {}".format(episode_reward))
 print(f"Spend {time.time() - start_time:.3f} s to run {horizon} steps")
 
-path = "test_images/view_rgb.mp4"
-imageio.mimsave(path, frames_rgb, fps=30)
-path = "test_images/view_depth.mp4"
-imageio.mimsave(path, frames_depth, fps=30)
+# encode both videos concurrently in background threads (ffmpeg releases the GIL)
+with ThreadPoolExecutor(max_workers=2) as video_writer:
+    videos = [
+        video_writer.submit(imageio.mimsave, "test_images/view_rgb.mp4", frames_rgb[:num_steps + 1], fps=30, macro_block_size=1),
+        video_writer.submit(imageio.mimsave, "test_images/view_depth.mp4", frames_depth[:num_steps + 1], fps=30, macro_block_size=1),
+    ]
+    for video in videos:
+        video.result()    # re-raises encoding errors
 
 # model_data = np.load("../robosuite_task/log_20230704_164646/model_data/20230628T100123-5c202889259044b1be711866ddb7b3ce-100.npz")
 # policy_data = np.load("../robosuite_task/log_20230704_164646/policy_data/20230704T165324-426efc5479b844b8908d70737512d46f-101.npz")
@@ -62,6 +62,20 @@ class RSSM(tools.Module):
         prior = {k: tf.transpose(v, [1, 0, 2]) for k, v in prior.items()}    # transpose each value element of prior dictionary without changing keys
         return prior
 
+    def pack_state(self, state):
+        # single [..., 3*30+200=290] tensor so that loops carry one buffer instead of a dict of four
+        return tf.concat([state['mean'], state['std'], state['stoch'], state['deter']], -1)
+
+    def unpack_state(self, packed):
+        mean, std, stoch, deter = tf.split(packed, [self._stoch_size, self._stoch_size, self._stoch_size, self._deter_size], -1)
+        return {'mean': mean, 'std': std, 'stoch': stoch, 'deter': deter}
+
+    def img_step_packed(self, prev_state, prev_action):
+        """
+        `img_step` on packed states, see `pack_state`.
+        """
+        return self.pack_state(self.img_step(self.unpack_state(prev_state), prev_action))
+
     def get_feat(self, state):
         return tf.concat([state['stoch'], state['deter']], -1)        # concatenates the stochastic and deterministic part of state
 
@@ -209,6 +223,21 @@ class DenseEncoder(tools.Module):
         return tf.reshape(x, shape)
 
 
+class CombinedEncoder(tools.Module):
+    def __init__(self, image_encoder, proprio_encoder=None):
+        self._image_encoder = image_encoder        # ConvEncoder
+        self._proprio_encoder = proprio_encoder    # DenseEncoder or None
+
+    def __call__(self, obs):
+        """
+        Returns the image embedding, followed by the proprioceptive embedding when a proprio encoder is given.
+        """
+        embed = self._image_encoder(obs)     # [128,50,1024]
+        if self._proprio_encoder is None:
+            return embed
+        return tf.concat([embed, self._proprio_encoder(obs)], axis=-1)    # [128,50,1024+32=1056]
+
+
 class DenseDecoder(tools.Module):
     def __init__(self, shape, layers, units, distribution='normal', act=tf.nn.elu):
         self._shape = shape    # ()
@@ -28,7 +28,8 @@ class Module(tf.Module):
     def save(self, filename):
         values = tf.nest.map_structure(lambda x: x.numpy(), self.variables)
         with pathlib.Path(filename).open('wb') as f:
-            pickle.dump(values, f)
+            # protocol 5 writes the numpy buffers straight into the file instead of through a bytes copy each
+            pickle.dump(values, f, protocol=5)
 
     def load(self, filename):
         with pathlib.Path(filename).open('rb') as f:
@@ -112,6 +113,8 @@ def simulate(agent, envs, steps=0, episodes=0, state=None):
         agent_state = None
     else:
         step, episode, done, length, obs, agent_state = state
+    # steps of the episodes finished in this call, so callers can keep count without rescanning the datadir
+    new_steps = 0
     
     while (steps and step < steps) or (episodes and episode < episodes):
         # Reset envs if necessary.
@@ -135,10 +138,11 @@ def simulate(agent, envs, steps=0, episodes=0, state=None):
         episode += int(done.sum())
         length += 1
         step += (done * length).sum()
+        new_steps += int((done * length).sum())
         length *= (1 - done)
     
-    # Return new state to allow resuming the simulation.
-    return (step - steps, episode - episodes, done, length, obs, agent_state)
+    # Return the new steps and the new state to allow resuming the simulation.
+    return new_steps, (step - steps, episode - episodes, done, length, obs, agent_state)
 
 
 def count_episodes(directory):
@@ -172,12 +176,11 @@ def save_episodes(directory, episodes):
                 f2.write(f1.read())
 
 
-def load_episodes(directory, rescan, batch_length=None, balance=False, seed=0, config=None):
-    print("Inside load directory:", directory)
-    directory = pathlib.Path(directory).expanduser()
-    random = np.random.RandomState(seed)
-    cache = {}
-
+def relevant_keys(config):
+    """
+        Names of the observation keys the agent consumes, given the 
+        observation modalities enabled in config.
+    """
     relevant_keys = ["reward", "action"]
     if config.use_camera_obs == True:
         relevant_keys.append(config.camera_names + "_image")
@@ -202,21 +205,36 @@ def load_episodes(directory, rescan, batch_length=None, balance=False, seed=0, c
     if config.use_touch_obs == True:
         relevant_keys.append("robot0_touch")
         relevant_keys.append("robot0_touch-state")
+    return relevant_keys
+
+
+def load_episode(filename, keys):
+    with filename.open('rb') as f:
+        raw_episode = np.load(f)
+        episode = {}
+        for k, v in raw_episode.items():
+            if k in keys:
+                if v.dtype.kind == 'f' and v.dtype != 'float32':
+                    # float64 observations and float16 episodes stored with precision 16 are both read as float32
+                    episode[k] = v.astype('float32')
+                else:
+                    episode[k] = v
+        # episode = {k: raw_episode[k] for k in raw_episode.keys()}
+    return episode
+
+
+def load_episodes(directory, rescan, batch_length=None, balance=False, seed=0, config=None):
+    print("Inside load directory:", directory)
+    directory = pathlib.Path(directory).expanduser()
+    random = np.random.RandomState(seed)
+    cache = {}
+    obs_keys = relevant_keys(config)
     
     while True:
         for filename in directory.glob('*.npz'):
             if filename not in cache:
                 try:
-                    with filename.open('rb') as f:
-                        raw_episode = np.load(f)
-                        episode = {}
-                        for k, v in raw_episode.items():
-                            if k in relevant_keys:
-                                if v.dtype == 'float64':
-                                    episode[k] = v.astype('float32')
-                                else:
-                                    episode[k] = v
-                        # episode = {k: raw_episode[k] for k in raw_episode.keys()}
+                    episode = load_episode(filename, obs_keys)
                 except Exception as e:
                     print(f'Could not load episode: {e}')
                     continue
@@ -244,6 +262,97 @@ def load_episodes(directory, rescan, batch_length=None, balance=False, seed=0, c
             yield episode
 
 
+class EpisodeCache:
+    """
+        Episodes of a directory held in host memory as non-trainable variables of 
+        shape [capacity, length, ...], zero-padded to the longest episode, along 
+        with the length of every episode. `update` loads the episodes saved since 
+        its last call, `sample` slices random segments out of them in the graph, 
+        so that a tf.data pipeline can draw batches without a Python generator.
+    """
+
+    def __init__(self, directory, keys, min_length=1):
+        self._directory = pathlib.Path(directory).expanduser()
+        self._keys = keys
+        self._min_length = min_length
+        self._filenames = set()
+        self._data = None
+        self._lengths = None
+        self._capacity, self._length = 0, 0
+        with tf.device('cpu:0'):
+            self._size = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.update()
+        assert self._data is not None, f'No episodes longer than {min_length - 1} steps found in {self._directory}.'
+
+    def update(self):
+        """
+            Appends the episodes saved to the directory since the last call, 
+            returns how many were added.
+        """
+        episodes = []
+        for filename in sorted(self._directory.glob('*.npz')):
+            if filename in self._filenames:
+                continue
+            try:
+                episode = load_episode(filename, self._keys)
+            except Exception as e:
+                print(f'Could not load episode: {e}')
+                continue
+            self._filenames.add(filename)
+            if len(episode['action']) < self._min_length:
+                print(f'Skipped short episode of length {len(episode["action"])}.')
+                continue
+            episodes.append(episode)
+        if not episodes:
+            return 0
+        
+        size = int(self._size.numpy())
+        with tf.device('cpu:0'):
+            self._reserve(episodes[0], size + len(episodes), max(len(episode['action']) for episode in episodes))
+            for index, episode in enumerate(episodes, size):
+                for k, v in episode.items():
+                    self._data[k][index, :len(v)].assign(v)
+                self._lengths[index].assign(len(episode['action']))
+            # the size is raised last, so `sample` never draws from a slot that is still being written
+            self._size.assign(size + len(episodes))
+        return len(episodes)
+
+    def sample(self, batch_size, batch_length, balance=False):
+        """
+            Draws `batch_size` segments of `batch_length` steps, from random episodes 
+            and random starts within each episode's own length, like `load_episodes`.
+        """
+        episode = tf.random.uniform([batch_size], 0, self._size, tf.int64)
+        total = tf.gather(self._lengths, episode)
+        available = total - batch_length
+        offset = tf.random.uniform([batch_size], 0, tf.int64.max, tf.int64)
+        start = tf.minimum(offset % total, available) if balance else offset % available
+        steps = start[:, None] + tf.range(batch_length, dtype=tf.int64)
+        indices = tf.stack([tf.broadcast_to(episode[:, None], tf.shape(steps)), steps], -1)
+        # gathered straight from the variables, so no read copies the whole cache
+        return {k: tf.gather_nd(v, indices) for k, v in self._data.items()}
+
+    def _reserve(self, episode, size, length):
+        # the capacity grows by doubling, so appending copies the cached episodes only a logarithmic number of times
+        capacity = max(self._capacity, 1)
+        while capacity < size:
+            capacity *= 2
+        length = max(self._length, length)
+        if self._data is None:
+            self._data = {
+                k: tf.Variable(np.zeros((capacity, length) + v.shape[1:], v.dtype), trainable=False, 
+                               shape=tf.TensorShape([None, None] + list(v.shape[1:])))
+                for k, v in episode.items()}
+            self._lengths = tf.Variable(np.zeros(capacity, np.int64), trainable=False, shape=tf.TensorShape([None]))
+        elif capacity > self._capacity or length > self._length:
+            # the variables keep their identity, so graphs that captured them read the grown buffers
+            for v in self._data.values():
+                padding = [[0, capacity - self._capacity], [0, length - self._length]] + [[0, 0]] * (v.shape.ndims - 2)
+                v.assign(tf.pad(v, padding))
+            self._lengths.assign(tf.pad(self._lengths, [[0, capacity - self._capacity]]))
+        self._capacity, self._length = capacity, length
+
+
 class DummyEnv:
 
     def __init__(self):
@@ -396,6 +505,23 @@ def lambda_return(
     return returns
 
 
+def constant_lambda_return(reward, value, discount, bootstrap, lambda_):
+    # Closed form of `lambda_return` along axis 0 for a constant python float discount: 
+    # the reverse scan becomes a single matmul with the upper triangular matrix of 
+    # powers of discount * lambda_. Needs a static horizon.
+    if bootstrap is None:
+        bootstrap = tf.zeros_like(value[-1])
+    next_values = tf.concat([value[1:], bootstrap[None]], 0)
+    inputs = reward + discount * next_values * (1 - lambda_)
+    horizon = reward.shape[0]
+    exponents = np.arange(horizon)[None, :] - np.arange(horizon)[:, None]
+    weights = np.where(exponents >= 0, (discount * lambda_) ** np.maximum(exponents, 0), 0.0)
+    bootstrap_weights = (discount * lambda_) ** (horizon - np.arange(horizon))
+    bootstrap_weights = bootstrap_weights.reshape([horizon] + [1] * (reward.shape.ndims - 1))
+    returns = tf.tensordot(tf.constant(weights, reward.dtype), inputs, axes=1)
+    return returns + tf.constant(bootstrap_weights, reward.dtype) * bootstrap[None]
+
+
 class Adam(tf.Module):
 
     def __init__(self, name, modules, lr, clip=None, wd=None, wdpattern=r'.*'):
@@ -414,6 +540,12 @@ class Adam(tf.Module):
         return self._opt.variables()
 
     def __call__(self, tape, loss):
+        grads, norm = self.gradients(tape, loss)
+        self.apply(grads)
+        return norm
+
+    def gradients(self, tape, loss):
+        # Split from `apply` so that the gradients can be computed inside an XLA-compiled function.
         if self._variables is None:
             variables = [module.variables for module in self._modules]
             self._variables = tf.nest.flatten(variables)
@@ -427,11 +559,13 @@ class Adam(tf.Module):
         norm = tf.linalg.global_norm(grads)
         if self._clip:
             grads, _ = tf.clip_by_global_norm(grads, self._clip, norm)
+        return grads, norm
+
+    def apply(self, grads):
         if self._wd:
             context = tf.distribute.get_replica_context()
             context.merge_call(self._apply_weight_decay)
         self._opt.apply_gradients(zip(grads, self._variables))
-        return norm
 
     def _apply_weight_decay(self, strategy):
         print('Applied weight decay to variables:')
@@ -514,3 +648,27 @@ class Once:
             self._once = False
             return True
         return False
+
+
+class RandomAgent:
+    """
+        Uniformly random policy over a Box action space, used to prefill the datasets. 
+        Actions for `buffer_size` steps of all envs are sampled in one call and handed 
+        out a step at a time, instead of sampling every env's action separately.
+    """
+    def __init__(self, actspace, buffer_size=4096, seed=0):
+        self._low = actspace.low
+        self._high = actspace.high
+        self._buffer_size = buffer_size
+        self._random = np.random.RandomState(seed)
+        self._buffer = None
+        self._index = 0
+
+    def __call__(self, obs, done, state):
+        if self._buffer is None or self._index == self._buffer_size or self._buffer.shape[1] != len(done):
+            shape = (self._buffer_size, len(done)) + self._low.shape
+            self._buffer = self._random.uniform(self._low, self._high, shape).astype(np.float32)
+            self._index = 0
+        action = self._buffer[self._index]
+        self._index += 1
+        return action, None
@@ -1,10 +1,13 @@
 import argparse
-import collections
+import atexit
 import functools
 import json
+import multiprocessing
 import os
 import pathlib
+import queue
 import sys
+import threading
 import time
 from datetime import datetime
 import pytz
@@ -47,7 +50,7 @@ def define_config():
     config.log_scalars = True
     config.log_images = True
     config.gpu_growth = True
-    config.precision = 32
+    config.precision = 16
 
     # Environment.
     config.env = 'robosuite'
@@ -121,6 +124,9 @@ def define_config():
 
 
 class VMAIL(tools.Module):
+    # the expert cache holds data rather than parameters, keep it out of `self.variables` and thus out of checkpoints
+    _TF_MODULE_IGNORED_PROPERTIES = tools.Module._TF_MODULE_IGNORED_PROPERTIES.union({'_expert_cache', '_expl_amount'})
+
     def __init__(self, config, model_datadir, policy_datadir, expert_datadir, actspace, writer):
         self._c = config
         self._camview_rgb = self._c.camera_names + "_image"
@@ -131,34 +137,68 @@ class VMAIL(tools.Module):
         self._random = np.random.RandomState(config.seed)
         
         with tf.device('cpu:0'):
-            self._step = tf.Variable(count_steps(policy_datadir, config), dtype=tf.int64)
+            self._step = tf.Variable(load_step_count(config.logdir, policy_datadir, config), dtype=tf.int64)
+        # host-side mirror of self._step, so that the schedules below don't read the variable on every env step
+        self._host_step = int(self._step.numpy())
         
         self._should_pretrain = tools.Once()
         self._should_train = tools.Every(config.train_every)
         self._should_log = tools.Every(config.log_every)
         self._last_log = None
         self._last_time = time.time()
-        self._metrics = collections.defaultdict(tf.metrics.Mean)
-        self._metrics['expl_amount']    # Create variable for checkpoint.
+        # metrics.jsonl is appended to from a background thread so that logging doesn't block on file I/O
+        self._jsonl_queue = jsonl_writer(self._c.logdir / 'metrics.jsonl')
+        # every metric is created up front (also for the checkpoint) so that none is allocated while tracing the training step
+        metric_names = ['expl_amount', 'model_grad_norm', 'discriminator_norm', 'value_grad_norm', 'actor_grad_norm', 'prior_ent', 'post_ent', 
+                        'expert_d', 'policy_d', 'max_policy_d', 'rewards', 'image_loss', 'div', 'model_loss', 'expert_loss', 'policy_loss', 
+                        'discriminator_loss', 'discriminator_penalty', 'value_loss', 'actor_loss', 'action_ent']
+        if config.pcont:
+            metric_names.append('pcont_loss')
+        self._metrics = {name: tf.metrics.Mean(name=name) for name in metric_names}
         self._float = prec.global_policy().compute_dtype
-        self._strategy = tf.distribute.MirroredStrategy()
+        # the per-step preprocessing runs as one graph rather than as an eager op per observation key
+        self._preprocess = tf.function(functools.partial(preprocess, config=config))
+        # the exploration type is fixed by the config, so only its branch is traced into the policy
+        self._explore = dict(additive_gaussian=self._additive_gaussian, completely_random=self._completely_random, 
+                             epsilon_greedy=self._epsilon_greedy)[config.expl]
+        # the decay schedule is evaluated on the host, see `_expl_schedule`
+        self._expl_amount = tf.Variable(self._expl_schedule(self._host_step), trainable=False, dtype=tf.float32)
+        # imported once here rather than from the training step, which would re-run the imports on every trace
+        self._shape_modules = load_shape_modules() if config.use_shape_obs else None
+        # mirroring only pays off with several gpus, on a single device the default strategy avoids the replica bookkeeping
+        gpus = tf.config.list_physical_devices('GPU')
+        self._multi_gpu = len(gpus) > 1
+        self._strategy = tf.distribute.MirroredStrategy() if self._multi_gpu else tf.distribute.get_strategy()
+        # losses are summed over replicas, a python float is inlined as a constant in every traced graph
+        self._replica_scale = 1.0 / self._strategy.num_replicas_in_sync
+        # distributed iterators stage batches on every replica themselves, a single gpu gets them prefetched into its memory directly
+        dataset_device = '/gpu:0' if len(gpus) == 1 else None
+        
+        # collected episodes live in host memory, outside the strategy scope so that they aren't mirrored onto every gpu
+        self._model_cache = tools.EpisodeCache(model_datadir, tools.relevant_keys(config), min_length=config.batch_length + 1)
         
         with self._strategy.scope():
-            # create tensorflow python distributed iterator objects
-            self._model_dataset = iter(self._strategy.experimental_distribute_dataset(load_dataset(model_datadir, self._c)))    # tensorflow.python.distribute.input_lib.DistributedIterator object
-            self._expert_dataset = iter(self._strategy.experimental_distribute_dataset(load_dataset(expert_datadir, self._c)))    # tensorflow.python.distribute.input_lib.DistributedIterator object
+            self._model_dataset = iter(self._distribute(load_dataset(self._model_cache, self._c, device=dataset_device)))
+            # expert demonstrations never change, so they are kept in device memory and the dataset only yields (episode, start) indices into them
+            self._expert_cache, expert_lengths = load_expert_cache(expert_datadir, self._c)
+            self._expert_dataset = iter(self._distribute(load_expert_indices(expert_lengths, self._c)))
             self._build_model()
+        
+        # every batch has the same spec, and `log_images` is a tensor, so the training step is traced exactly once
+        self.train = tf.function(self._train_step, input_signature=[
+            self._model_dataset.element_spec, self._expert_dataset.element_spec, tf.TensorSpec([], tf.bool)])
 
 
     def __call__(self, obs, reset, state=None, training=True):
-        step = self._step.numpy().item()
-        tf.summary.experimental.set_step(step)
+        step = self._host_step
+        tf.summary.experimental.set_step(self._step)    # the variable is only read when a summary is written
         
         if state is not None and reset.any():
             mask = tf.cast(1 - reset, self._float)[:, None]
             state = tf.nest.map_structure(lambda x: x * mask, state)
         
         if self._should_train(step):
+            self._model_cache.update()
             log = self._should_log(step)
             n = self._c.pretrain if self._should_pretrain() else self._c.train_steps
             
@@ -170,14 +210,19 @@ class VMAIL(tools.Module):
             if log:
                 self._write_summaries()
         
-        action, state = self.policy(obs, state, training)
+        if training and self._c.expl_decay:
+            self._expl_amount.assign(self._expl_schedule(step))
+        
+        # preprocessing pins the casts to the cpu, which cannot be honoured inside the XLA-compiled policy
+        action, state = self.policy(self._preprocess(obs), state, training)
         if training:
-            self._step.assign_add(len(reset) * self._c.action_repeat)
+            self._host_step += len(reset) * self._c.action_repeat
+            self._step.assign(self._host_step)
         
         return action, state
 
 
-    @tf.function
+    @tf.function(jit_compile=True)
     def policy(self, obs, state, training:bool=True):
         if state is None:
             latent = self._dynamics_model.initialize(batch_size=len(obs[self._camview_rgb]))
@@ -185,10 +230,8 @@ class VMAIL(tools.Module):
         else:
             latent, action = state
         
-        embed = self._encode(preprocess(obs, self._c))     # [128,50,1024]
-        if self._c.use_proprio_obs == True:
-            embed_proprio = self._encode_proprio(obs)                # [128,50,32]
-            embed = tf.concat([embed, embed_proprio], axis=-1)     # [128,50,1056]
+        obs = normalize_images(obs, self._c)
+        embed = self._encode(obs)     # [128,50,1024] or [128,50,1056] with proprio
         
         latent, _ = self._dynamics_model.obs_step(latent, action, embed)    # returns (posterior, prior) dictionaries
         feat = self._dynamics_model.get_feat(latent)
@@ -204,23 +247,6 @@ class VMAIL(tools.Module):
         return action, state
     
 
-    # def load_shape_modules(self):
-    #     sys.path.append("/home/saqibcephsharedvol2/ERLab/IRL_Project/SceneGrasp/")
-        
-    #     from common.utils.nocs_utils import load_depth
-    #     from common.utils.misc_utils import (
-    #             convert_realsense_rgb_depth_to_o3d_pcl,
-    #             get_o3d_pcd_from_np,
-    #             get_scene_grasp_model_params,
-    #     )
-    #     from common.utils.scene_grasp_utils import (
-    #             SceneGraspModel,
-    #             get_final_grasps_from_predictions_np,
-    #             get_grasp_vis,
-    #     )
-    #     print("Importing Scenegrasp")
-    
-
     # def estimate_object_shape(self):
     #     """
     #         Estimates the 3d point cloud shape of each object in the scene. 
@@ -263,12 +289,23 @@ class VMAIL(tools.Module):
 
     def load(self, filename):
         super().load(filename)
+        self._host_step = int(self._step.numpy())
         self._should_pretrain()
 
 
-    @tf.function()
-    def train(self, model_data, expert_data, log_images=False):
-        self._strategy.run(self._train, args=(model_data, expert_data, log_images))
+    def _distribute(self, dataset):
+        if self._multi_gpu:
+            # tensorflow.python.distribute.input_lib.DistributedDataset object
+            return self._strategy.experimental_distribute_dataset(dataset)
+        return dataset
+
+
+    def _train_step(self, model_data, expert_data, log_images):
+        # strategy.run cannot be XLA-compiled across replicas, so the replica function jit-compiles its forward passes instead.
+        if self._multi_gpu:
+            self._strategy.run(self._train, args=(model_data, expert_data, log_images))
+        else:
+            self._train(model_data, expert_data, log_images)
 
 
     def _train(self, model_data, expert_data, log_images):
@@ -276,116 +313,168 @@ class VMAIL(tools.Module):
         model_data: environment buffer trajectory samples (observation, action, next observation)
         expert_data: expert trajectory samples (observation, action)
         """
+        # the images stay uint8 (and uint16 depth) up to `_forward`, which normalizes them inside the compiled graph
+        expert_data = self._gather_expert(*expert_data)
 
-        # context manager that records tensor operations for autodiff 
-        with tf.GradientTape() as model_tape:
-            # compute embedded features for images sampled from policy
-            embed = self._encode(model_data)                    # [128, 50, 1024]
-            if self._c.use_proprio_obs:
-                embed_proprio = self._encode_proprio(model_data)     # [128, 50, 32]
-                embed = tf.concat([embed, embed_proprio], axis=-1)    # [128,50,1056]
-            
-            if self._c.use_shape_obs:
-                self.load_shape_modules()
-                # embed_shape = self.estimate_object_shape()
-            
-            post, prior = self._dynamics_model.observe(embed=embed, action=model_data['action'])
-            feat = self._dynamics_model.get_feat(post)
-            image_pred = self._decode(feat)         # tfp.distributions.Independent("IndependentNormal", batch_shape=[128, 50], event_shape=[84, 84, 3/4], dtype=float32)
-            
-            likes = tools.AttrDict()    # just a simple python dict with obj.key instead of obj['key']
-            if self._c.use_depth_obs == True:
-                decoder_gt = tf.concat([model_data[self._camview_rgb], model_data[self._camview_depth]], axis=-1)
-            else:
-                decoder_gt = model_data[self._camview_rgb]
-
-            # computes the average log prob of ground-truth labels given the predictions
-            likes.image = tf.reduce_mean(image_pred.log_prob(decoder_gt))
-            
-            if self._c.pcont:     # False
-                pcont_pred = self._pcont(feat)
-                pcont_target = self._c.discount * model_data['discount']
-                likes.pcont = tf.reduce_mean(pcont_pred.log_prob(pcont_target))
-                likes.pcont *= self._c.pcont_scale
-            
-            # estimate prior and posterior transition dynamics distribution
-            prior_dist = self._dynamics_model.get_distribution(prior)
-            post_dist = self._dynamics_model.get_distribution(post)
+        model_out, agent_out, grads = self._forward(model_data, expert_data)
+        embed, post, prior, feat, image_mean, likes, div, model_loss = model_out
+        expert_d, expert_loss, policy_loss, grad_penalty, discriminator_loss, reward, actor_loss, value_loss = agent_out
+        (model_grads, model_norm), (discriminator_grads, discriminator_norm), (actor_grads, actor_norm), (value_grads, value_norm) = grads
 
-            # compute divergence
-            div = tf.reduce_mean(tfd.kl_divergence(post_dist, prior_dist))    # scalar divergence tensor
-            div = tf.maximum(div, self._c.free_nats)
-            
-            model_loss = self._c.kl_scale * div - sum(likes.values())    # Eq.7 in vmail paper
-            model_loss /= float(self._strategy.num_replicas_in_sync)
-            
-        with tf.GradientTape(persistent=True) as agent_tape:
-            imag_feat, actions = self._imagine_ahead(post)
-            
-            # compute embedded features for images from expert data
-            embed_expert = self._encode(expert_data)                                     # [128,50,1024]
-            if self._c.use_proprio_obs == True:
-                embed_expert_proprio = self._encode_proprio(expert_data)     # [128,50,32]
-                embed_expert = tf.concat([embed_expert, embed_expert_proprio], axis=-1)     # [128,50,1056]
-            
-            post_expert, prior_expert = self._dynamics_model.observe(embed=embed_expert, action=expert_data['action'])
-            feat_expert = self._dynamics_model.get_feat(post_expert)
-         
-            feat_expert_dist = tf.concat([feat_expert[:, :-1], expert_data['action'][:, 1:]], axis = -1)    # [128,49,237]
-            feat_policy_dist = tf.concat([imag_feat[:-1], actions], axis = -1)
-
-            expert_d, _ = self._discriminator(feat_expert_dist)
-            policy_d, _ = self._discriminator(feat_policy_dist)
-            
-            expert_loss = tf.reduce_mean(expert_d.log_prob(tf.ones_like(expert_d.mean())))
-            policy_loss = tf.reduce_mean(policy_d.log_prob(tf.zeros_like(policy_d.mean())))
+        self._model_opt.apply(model_grads)
+        self._discriminator_opt.apply(discriminator_grads)
+        self._actor_opt.apply(actor_grads)
+        self._value_opt.apply(value_grads)
+
+        if tf.distribute.get_replica_context().replica_id_in_sync_group == 0:
+            if self._c.log_scalars:
+                # estimate prior and posterior transition dynamics distribution
+                prior_dist = self._dynamics_model.get_distribution(prior)
+                post_dist = self._dynamics_model.get_distribution(post)
+                self._scalar_summaries(model_data, feat, prior_dist, post_dist, likes, div, model_loss, tf.reduce_mean(expert_d), tf.reduce_mean(reward), tf.reduce_max(tf.reduce_mean(reward, axis = 1)), expert_loss, policy_loss, grad_penalty, discriminator_loss, tf.reduce_mean(reward), value_loss, actor_loss, model_norm, discriminator_norm, value_norm, actor_norm)
             
-            with tf.GradientTape() as penalty_tape:
-                alpha = tf.expand_dims(tf.random.uniform(feat_policy_dist.shape[:2]), -1)
-                temp1 = tf.expand_dims(flatten(feat_expert_dist), 0)        # [1,6272,237]
-                temp2 = tf.tile(temp1, [self._c.horizon, 1, 1])                # [horizon,6272,237]
-
-                disc_penalty_input = alpha * feat_policy_dist + (1.0 - alpha) * temp2
-                _, logits = self._discriminator(disc_penalty_input)
-                discriminator_variables = tf.nest.flatten([self._discriminator.variables])
-                inner_discriminator_grads = penalty_tape.gradient(tf.reduce_mean(logits), discriminator_variables)
-                inner_discriminator_norm = tf.linalg.global_norm(inner_discriminator_grads)
-                grad_penalty = (inner_discriminator_norm - 1)**2
-
-            discriminator_loss = -(expert_loss + policy_loss) + self._c.alpha * grad_penalty
-            discriminator_loss /= float(self._strategy.num_replicas_in_sync)
-
-            reward = policy_d.mean()
-            if self._c.pcont:
-                pcont = self._pcont(imag_feat[1:]).mean()
-            else:
-                pcont = self._c.discount * tf.ones_like(reward)
-            value = self._value(imag_feat[1:]).mode()
+            if tf.equal(log_images, True):
+                # print("summary:", model_data, embed, image_pred)
+                self._image_summaries(normalize_images(model_data, self._c), embed, image_mean)
+
 
+    @tf.function(jit_compile=True)
+    def _forward(self, model_data, expert_data):
+        """
+        Forward passes, losses and gradients of all the modules in a single XLA-compiled graph. Returns tensors 
+        only; the gradients are applied outside since the optimizer updates synchronise across replicas.
+        """
+        # context manager that records tensor operations for autodiff, one tape for all losses; 
+        # each optimizer only differentiates its own loss w.r.t. its own variables
+        with tf.GradientTape(persistent=True) as tape:
+            # the policy and expert observations are encoded as one batch; the two passes don't depend on each other, and 
+            # a single wider conv keeps the gpu busier than two smaller ones issued back to back. The images are concatenated 
+            # before they are normalized, so the cast is fused into the graph instead of materializing float copies of both batches
+            batch_size = tf.shape(model_data['action'])[0]
+            data = normalize_images({k: tf.concat([model_data[k], expert_data[k]], 0) for k in model_data}, self._c)
+            embed = self._encode(data)
+            embed, embed_expert = tf.split(embed, [batch_size, tf.shape(expert_data['action'])[0]], 0)
+            model_data = {k: v[:batch_size] for k, v in data.items()}
+            model_out = self._model_forward(model_data, embed)
+            agent_out = self._agent_forward(model_out[1], expert_data, embed_expert)
+        
+        model_loss = model_out[-1]
+        _, _, _, _, discriminator_loss, _, actor_loss, value_loss = agent_out
+        grads = (
+            self._model_opt.gradients(tape, model_loss),
+            self._discriminator_opt.gradients(tape, discriminator_loss),
+            self._actor_opt.gradients(tape, actor_loss),
+            self._value_opt.gradients(tape, value_loss),
+        )
+        del tape
+        return model_out, agent_out, grads
+
+
+    def _model_forward(self, model_data, embed):
+        """
+        World model forward pass and loss on policy data, given its embedded features `embed`.
+        """
+        # if self._c.use_shape_obs:
+        #     embed_shape = self.estimate_object_shape()
+        
+        post, prior = self._dynamics_model.observe(embed=embed, action=model_data['action'])
+        feat = self._dynamics_model.get_feat(post)
+        image_pred = self._decode(feat)         # tfp.distributions.Independent("IndependentNormal", batch_shape=[128, 50], event_shape=[84, 84, 3/4], dtype=float32)
+        
+        likes = {}
+        if self._c.use_depth_obs == True:
+            decoder_gt = tf.concat([model_data[self._camview_rgb], model_data[self._camview_depth]], axis=-1)
+        else:
+            decoder_gt = model_data[self._camview_rgb]
+
+        # computes the average log prob of ground-truth labels given the predictions
+        likes['image'] = tf.reduce_mean(image_pred.log_prob(decoder_gt))
+        
+        if self._c.pcont:     # False
+            pcont_pred = self._pcont(feat)
+            pcont_target = self._c.discount * model_data['discount']
+            likes['pcont'] = tf.reduce_mean(pcont_pred.log_prob(pcont_target))
+            likes['pcont'] *= self._c.pcont_scale
+        
+        # estimate prior and posterior transition dynamics distribution
+        prior_dist = self._dynamics_model.get_distribution(prior)
+        post_dist = self._dynamics_model.get_distribution(post)
+
+        # compute divergence
+        div = tf.reduce_mean(tfd.kl_divergence(post_dist, prior_dist))    # scalar divergence tensor
+        div = tf.maximum(div, tf.cast(self._c.free_nats, self._float))
+        
+        model_loss = self._c.kl_scale * div - sum(likes.values())    # Eq.7 in vmail paper
+        model_loss *= self._replica_scale
+        
+        return embed, post, prior, feat, image_pred.mode(), likes, div, model_loss
+
+
+    def _agent_forward(self, post, expert_data, embed_expert):
+        """
+        Imagination rollout, discriminator, actor and value losses, given the embedded expert features `embed_expert`.
+        """
+        imag_feat, actions = self._imagine_ahead(post)
+        
+        post_expert, prior_expert = self._dynamics_model.observe(embed=embed_expert, action=expert_data['action'])
+        feat_expert = self._dynamics_model.get_feat(post_expert)
+     
+        feat_expert_dist = tf.concat([feat_expert[:, :-1], expert_data['action'][:, 1:]], axis = -1)    # [128,49,237]
+        feat_policy_dist = tf.concat([imag_feat[:-1], actions], axis = -1)
+
+        # one discriminator pass over the expert and policy rows together, the logits are split back afterwards
+        expert_flat = flatten(feat_expert_dist)        # [6272,237]
+        policy_flat = tf.reshape(feat_policy_dist, [-1, feat_policy_dist.shape[-1]])    # [15*6272,237]
+        _, logits = self._discriminator(tf.concat([expert_flat, policy_flat], 0))
+        expert_logits, policy_logits = tf.split(logits, [tf.shape(expert_flat)[0], tf.shape(policy_flat)[0]], 0)
+        expert_d = tfd.Bernoulli(logits=tf.reshape(expert_logits, tf.shape(feat_expert_dist)[:-1]))    # [128,49]
+        policy_d = tfd.Bernoulli(logits=tf.reshape(policy_logits, tf.shape(feat_policy_dist)[:-1]))    # [15,6272]
+        
+        expert_loss = tf.reduce_mean(expert_d.log_prob(tf.ones_like(expert_d.mean())))
+        policy_loss = tf.reduce_mean(policy_d.log_prob(tf.zeros_like(policy_d.mean())))
+        
+        with tf.GradientTape() as penalty_tape:
+            alpha = tf.expand_dims(tf.random.uniform(tf.shape(feat_policy_dist)[:2], dtype=self._float), -1)
+            # [1,6272,237] expert features broadcast against the horizon axis
+            disc_penalty_input = alpha * feat_policy_dist + (1.0 - alpha) * expert_flat[None]
+            _, logits = self._discriminator(disc_penalty_input)
+            discriminator_variables = tf.nest.flatten([self._discriminator.variables])
+            inner_discriminator_grads = penalty_tape.gradient(tf.reduce_mean(logits), discriminator_variables)
+            inner_discriminator_norm = tf.linalg.global_norm(inner_discriminator_grads)
+            grad_penalty = (inner_discriminator_norm - 1)**2
+
+        discriminator_loss = -(expert_loss + policy_loss) + self._c.alpha * grad_penalty
+        discriminator_loss *= self._replica_scale
+
+        reward = policy_d.mean()
+        value = self._value(imag_feat[1:]).mode()
+
+        if self._c.pcont:
+            pcont = self._pcont(imag_feat[1:]).mean()
             returns = tools.lambda_return(reward[:-1], value[:-1], pcont[:-1], bootstrap=None, lambda_ = 1.0, axis=0)
-            
             discount = tf.stop_gradient(tf.math.cumprod(tf.concat([tf.ones_like(pcont[:1]), pcont[:-2]], 0), 0))
-            actor_loss = -tf.reduce_mean(discount * returns)
-            actor_loss /= float(self._strategy.num_replicas_in_sync)
+        else:
+            # with a constant discount neither the return nor the discount weights need a sequential scan over the horizon
+            returns = tools.constant_lambda_return(reward[:-1], value[:-1], self._c.discount, bootstrap=None, lambda_ = 1.0)
+            discount = tf.constant(self._c.discount ** np.arange(self._c.horizon - 1), self._float)[:, None]    # [14,1]
+        actor_loss = -tf.reduce_mean(discount * returns)
+        actor_loss *= self._replica_scale
 
-        with tf.GradientTape() as value_tape:
-            value_pred = self._value(imag_feat[1:])[:-1]
-            target = tf.stop_gradient(returns)
-            value_loss = -tf.reduce_mean(discount * value_pred.log_prob(target))
-            value_loss /= float(self._strategy.num_replicas_in_sync)
+        value_pred = self._value(imag_feat[1:])[:-1]
+        target = tf.stop_gradient(returns)
+        value_loss = -tf.reduce_mean(discount * value_pred.log_prob(target))
+        value_loss *= self._replica_scale
 
-        model_norm = self._model_opt(model_tape, model_loss)
-        discriminator_norm = self._discriminator_opt(agent_tape, discriminator_loss)
-        actor_norm = self._actor_opt(agent_tape, actor_loss)
-        value_norm = self._value_opt(value_tape, value_loss)
+        return expert_d.mean(), expert_loss, policy_loss, grad_penalty, discriminator_loss, reward, actor_loss, value_loss
 
-        if tf.distribute.get_replica_context().replica_id_in_sync_group == 0:
-            if self._c.log_scalars:
-                self._scalar_summaries(model_data, feat, prior_dist, post_dist, likes, div, model_loss, tf.reduce_mean(expert_d.mean()), tf.reduce_mean(policy_d.mean()), tf.reduce_max(tf.reduce_mean(policy_d.mean(), axis = 1)), expert_loss, policy_loss, grad_penalty, discriminator_loss, tf.reduce_mean(reward), value_loss, actor_loss, model_norm, discriminator_norm, value_norm, actor_norm)
-            
-            if tf.equal(log_images, True):
-                # print("summary:", model_data, embed, image_pred)
-                self._image_summaries(model_data, embed, image_pred)
+
+    def _gather_expert(self, episode, start):
+        """
+        Slices `batch_length` long segments starting at `start` out of the cached expert episodes `episode`.
+        """
+        steps = start[:, None] + tf.range(self._c.batch_length, dtype=start.dtype)    # [128,50]
+        indices = tf.stack([tf.broadcast_to(episode[:, None], tf.shape(steps)), steps], -1)    # [128,50,2]
+        return {k: tf.gather_nd(v, indices) for k, v in self._expert_cache.items()}
 
 
     def _build_model(self):
@@ -393,10 +482,13 @@ class VMAIL(tools.Module):
         cnn_act = acts[self._c.cnn_act]
         dense_act = acts[self._c.dense_act]
 
-        self._encode = models.ConvEncoder(self._c.cnn_depth, cnn_act, camview_rgb=self._camview_rgb, camview_depth=self._camview_depth, use_depth_obs=self._c.use_depth_obs)
+        encode_image = models.ConvEncoder(self._c.cnn_depth, cnn_act, camview_rgb=self._camview_rgb, camview_depth=self._camview_depth, use_depth_obs=self._c.use_depth_obs)
 
+        encode_proprio = None
         if self._c.use_proprio_obs == True:
-            self._encode_proprio = models.DenseEncoder(self._c.out_units, num_layers=0, hidden_units=self._c.hidden_units, activation=dense_act, camview_rgb=self._camview_rgb)
+            encode_proprio = models.DenseEncoder(self._c.out_units, num_layers=0, hidden_units=self._c.hidden_units, activation=dense_act, camview_rgb=self._camview_rgb)
+        
+        self._encode = models.CombinedEncoder(encode_image, encode_proprio)
 
         self._dynamics_model = models.RSSM(self._c.stoch_size, self._c.deter_size, self._c.deter_size)
         self._decode = models.ConvDecoder(self._c.cnn_depth, cnn_act, use_depth_obs=self._c.use_depth_obs)
@@ -406,8 +498,6 @@ class VMAIL(tools.Module):
         self._actor = models.ActionDecoder(self._actdim, 4, self._c.num_units, self._c.action_dist, init_std=self._c.action_init_std, act=dense_act)
         
         model_modules = [self._encode, self._dynamics_model, self._decode, self._reward]
-        if self._c.use_proprio_obs == True:
-            model_modules.append(self._encode_proprio)
 
         if self._c.pcont:
             self._pcont = models.DenseDecoder((), 3, self._c.num_units, 'binary', act=act)
@@ -420,30 +510,40 @@ class VMAIL(tools.Module):
         self._actor_opt = Optimizer('actor', [self._actor], self._c.actor_lr)
         
     
+    def _expl_schedule(self, step):
+        amount = self._c.expl_amount
+        if self._c.expl_decay:     # False
+            amount *= 0.5 ** (step / self._c.expl_decay)
+        if self._c.expl_min:        # False
+            amount = max(self._c.expl_min, amount)
+        return amount
+
+
     def _exploration(self, action, training:bool=True):
         if training:
-            amount = self._c.expl_amount
-            if self._c.expl_decay:     # False
-                amount *= 0.5 ** (tf.cast(self._step, tf.float32) / self._c.expl_decay)
-            if self._c.expl_min:        # False
-                amount = tf.maximum(self._c.expl_min, amount)
+            amount = self._expl_amount
             self._metrics['expl_amount'].update_state(amount)
         elif self._c.eval_noise:
             amount = self._c.eval_noise
         else:
             return action
-        
-        if self._c.expl == 'additive_gaussian':
-            return tf.clip_by_value(tfd.Normal(action, amount).sample(), -1, 1)
-        elif self._c.expl == 'completely_random':
-            return tf.random.uniform(action.shape, -1, 1)
-        elif self._c.expl == 'epsilon_greedy':
-            indices = tfd.Categorical(0 * action).sample()
-            return tf.where(tf.random.uniform(action.shape[:1], 0, 1) < amount, tf.one_hot(indices, action.shape[-1], dtype=self._float), action)
-        
-        raise NotImplementedError(self._c.expl)
+        return self._explore(action, tf.cast(amount, self._float))
+
+
+    def _additive_gaussian(self, action, amount):
+        return tf.clip_by_value(tfd.Normal(action, amount).sample(), -1, 1)
+
+
+    def _completely_random(self, action, amount):
+        return tf.random.uniform(action.shape, -1, 1, dtype=self._float)
+
+
+    def _epsilon_greedy(self, action, amount):
+        indices = tfd.Categorical(0 * action).sample()
+        return tf.where(tf.random.uniform(action.shape[:1], 0, 1, dtype=self._float) < amount, tf.one_hot(indices, action.shape[-1], dtype=self._float), action)
 
     
+    @tf.function(jit_compile=True)
     def _imagine_ahead(self, post):
         """
         Input: [128,50] batch of posterior distribution of latent state and using this as start state, 
@@ -457,33 +557,31 @@ class VMAIL(tools.Module):
         post = {k: v[:, :-1] for k, v in post.items()}    # exclude the last element (why ??)
         # post = {mean:[128,49,30], std:[128,49,30], stoch:[128,49,30], deter:[128,49,200]}
         
-        flatten = lambda x: tf.reshape(x, [-1] + list(x.shape[2:]))
         start_state = {k: flatten(v) for k, v in post.items()}     # {mean:[6272,30], std:[6272,30], stoch:[6272,30], deter:[6272,200]}
-
-        policy = lambda state: self._actor(tf.stop_gradient(self._dynamics_model.get_feat(state))).sample()
-        
-        last_state = start_state
-        # print("tf.nest.flatten:", tf.nest.flatten(start_state), tf.nest.flatten(last_state))
-        # tf.nest.flatten(start_state) = [tf.tensor (6272,200), tf.tensor (6272,30), tf.tensor (6272,30), tf.tensor (6272,30)]
-        outputs = [[] for _ in tf.nest.flatten(start_state)]
-        [o.append(l) for o, l in zip(outputs, tf.nest.flatten(last_state))]
-        # print("before:", outputs)
-
-        actions = []
-        for index in range(self._c.horizon):    # why horizon=15 ??
-            action = policy(last_state)
-            last_state = self._dynamics_model.img_step(last_state, action)     # given current state `last_state` and `action`, find next state using learned transition dynamics
-            [o.append(l) for o, l in zip(outputs, tf.nest.flatten(last_state))]
-            actions.append(action)
-        
-        # print("length of outputs:", len(outputs))
-        outputs = [tf.stack(x, 0) for x in outputs]    # [tensor(16,6272,200), tensor(16,6272,30), tensor(16,6272,30), tensor(16,6272,30)]
-        actions = tf.stack(actions, 0)     # tensor(15, 6272, 7)
-        # print("actions:", actions)
-        states = tf.nest.pack_sequence_as(start_state, outputs)    # {mean:tensor(16,6272,30), std:tensor(16,6272,30), stoch:tensor(16,6272,30), deter:tensor(16,6272,200)}
-        # print("states:", states)
+        start_state = self._dynamics_model.pack_state(start_state)    # [6272,290]
+
+        policy = lambda state: self._actor(tf.stop_gradient(self._dynamics_model.get_feat(self._dynamics_model.unpack_state(state)))).sample()
+
+        def step(index, state, states, actions):
+            action = policy(state)
+            state = self._dynamics_model.img_step_packed(state, action)     # given current state and `action`, find next state using learned transition dynamics
+            return index + 1, state, states.write(index + 1, state), actions.write(index, action)
+
+        # fixed-size buffers for the rollout, the start state goes into the first slot so nothing needs to be concatenated afterwards
+        states = tf.TensorArray(self._float, size=self._c.horizon + 1, element_shape=start_state.shape, clear_after_read=False)
+        actions = tf.TensorArray(self._float, size=self._c.horizon, element_shape=[start_state.shape[0], self._actdim], clear_after_read=False)
+        states = states.write(0, start_state)
+
+        # the first step runs outside the loop so that the actor's layers are never created inside the loop body
+        _, state, states, actions = step(0, start_state, states, actions)
+        # the static bound lets XLA size the gradient accumulators of the loop, which the actor loss is differentiated through
+        _, _, states, actions = tf.while_loop(lambda index, *_: index < self._c.horizon, step, (1, state, states, actions), 
+                                              maximum_iterations=self._c.horizon - 1)
+        actions = actions.stack()     # tensor(15, 6272, 7)
+        states = states.stack()    # tensor(16,6272,290)
+        states = self._dynamics_model.unpack_state(states)    # {mean:tensor(16,6272,30), std:tensor(16,6272,30), stoch:tensor(16,6272,30), deter:tensor(16,6272,200)}
+        
         imag_feat = self._dynamics_model.get_feat(states)    # tensor(16, 6272, 30+200=230)
-        # print("image features:", imag_feat)
         return imag_feat, actions
 
     
@@ -511,14 +609,14 @@ class VMAIL(tools.Module):
         self._metrics['action_ent'].update_state(self._actor(feat).entropy())
 
     
-    def _image_summaries(self, data, embed, image_pred):
+    def _image_summaries(self, data, embed, image_mean):
         # print("inside image summaries:", data[self._camview_rgb].shape, data[self._camview_depth].shape, image_pred.mode().shape)
         if self._c.use_depth_obs == True:
             truth = tf.concat([data[self._camview_rgb][:6] + 0.5, data[self._camview_depth][:6] + 0.5], axis=-1)     # [6,50,84,84,4]
         else:
             truth = data[self._camview_rgb][:6] + 0.5             # [6,50,84,84,3]
         
-        recon = image_pred.mode()[:6]     # [6,50,84,84,3/4]
+        recon = image_mean[:6]     # [6,50,84,84,3/4]
         init, _ = self._dynamics_model.observe(embed[:6, :5], data['action'][:6, :5])
         init = {k: v[:, -1] for k, v in init.items()}
         
@@ -542,14 +640,90 @@ class VMAIL(tools.Module):
         self._last_log = step
         [m.reset_states() for m in self._metrics.values()]
         
-        with (self._c.logdir / 'metrics.jsonl').open('a') as f:
-            f.write(json.dumps({'step': step, **dict(metrics)}) + '\n')
+        self._jsonl_queue.put({'step': step, **dict(metrics)})
         
-        [tf.summary.scalar('agent/' + k, m) for k, m in metrics]
+        self._summarize_scalars({k: tf.constant(v, tf.float32) for k, v in metrics}, tf.constant(step, tf.int64))
         print(f'[{step}]', ' / '.join(f'{k} {v:.1f}' for k, v in metrics))
         self._writer.flush()
 
 
+    @tf.function
+    def _summarize_scalars(self, metrics, step):
+        # the step is passed explicitly since the default step is an int that summarize_episode keeps resetting, 
+        # which would otherwise be frozen into the trace
+        for k, m in metrics.items():
+            tf.summary.scalar('agent/' + k, m, step=step)
+
+
+_jsonl_writers = {}
+_jsonl_writers_lock = threading.Lock()
+
+
+def jsonl_writer(filename):
+    """
+    Returns the queue of the background thread appending to the JSONL file `filename`, starting it on the first call, 
+    so that the agent and the episode summaries share a single writer per file. At exit the queue is drained and the file closed. 
+    Only for the main process, child processes don't run atexit handlers.
+    """
+    with _jsonl_writers_lock:
+        if str(filename) not in _jsonl_writers:
+            entries = queue.Queue()
+            thread = threading.Thread(target=write_jsonl, args=(filename, entries), daemon=True)
+            thread.start()
+            
+            def close():
+                entries.put(None)
+                thread.join()
+            atexit.register(close)
+            _jsonl_writers[str(filename)] = entries
+        return _jsonl_writers[str(filename)]
+
+
+def write_jsonl(filename, entries):
+    """
+    Appends every dict put on the queue `entries` as a line to the JSONL file `filename`, which stays open in between, 
+    until None is put on the queue.
+    """
+    with filename.open('a') as f:
+        for entry in iter(entries.get, None):
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+
+
+def load_shape_modules():
+    """
+    Imports the SceneGrasp utilities used to estimate object shapes. 
+    Returns None if SceneGrasp is not available.
+    """
+    sys.path.append("/home/saqibcephsharedvol2/ERLab/IRL_Project/SceneGrasp/")
+    try:
+        from common.utils.nocs_utils import load_depth
+        from common.utils.misc_utils import (
+                convert_realsense_rgb_depth_to_o3d_pcl,
+                get_o3d_pcd_from_np,
+                get_scene_grasp_model_params,
+        )
+        from common.utils.scene_grasp_utils import (
+                SceneGraspModel,
+                get_final_grasps_from_predictions_np,
+                get_grasp_vis,
+        )
+    except ImportError as e:
+        print("Could not import SceneGrasp, object shapes are not available:", e)
+        return None
+    
+    print("Imported SceneGrasp")
+    return tools.AttrDict(
+            load_depth=load_depth,
+            convert_realsense_rgb_depth_to_o3d_pcl=convert_realsense_rgb_depth_to_o3d_pcl,
+            get_o3d_pcd_from_np=get_o3d_pcd_from_np,
+            get_scene_grasp_model_params=get_scene_grasp_model_params,
+            SceneGraspModel=SceneGraspModel,
+            get_final_grasps_from_predictions_np=get_final_grasps_from_predictions_np,
+            get_grasp_vis=get_grasp_vis,
+    )
+
+
 def flatten(x):
     '''
         if x.shape = [a, b, c, d, ...]
@@ -565,42 +739,122 @@ def preprocess(obs, config):
     obs = obs.copy()
 
     with tf.device('cpu:0'):
+        # the rgb image stays uint8 so that a quarter of the bytes are copied to the gpu, see `normalize_images`
         rgb_img_name = config.camera_names+'_image'
-        obs[rgb_img_name] = tf.cast(obs[rgb_img_name], dtype) / 255.0 - 0.5
+        depth_img_name = config.camera_names + '_depth'
         
         if config.use_depth_obs == True:
-            depth_img_name = config.camera_names + '_depth'
-            obs[depth_img_name] = tf.cast(obs[depth_img_name] - 0.5, dtype)
+            # the [0, 1] depth map is quantized to uint16, half the bytes of float32 for the copy to the gpu, see `normalize_images`
+            obs[depth_img_name] = tf.cast(tf.round(tf.clip_by_value(obs[depth_img_name], 0, 1) * 65535), tf.uint16)
         
         # a dictionary with 2 keys ('none': identity function, 'tanh': hyperbolic tangent)
         clip_rewards = dict(none=lambda x: x, tanh=tf.tanh)[config.clip_rewards]
         obs['reward'] = clip_rewards(obs['reward'])
         
         for k, v in obs.items():
-            obs[k] = tf.cast(v, dtype)
+            if k != rgb_img_name and not (k == depth_img_name and config.use_depth_obs):
+                obs[k] = tf.cast(v, dtype)
     
     return obs
 
 
+def normalize_images(obs, config):
+    """
+    Casts the uint8 rgb image (and the uint16 depth map) to the compute dtype and scales it to [-0.5, 0.5]. 
+    Called inside the XLA-compiled graphs, so that the cast runs on the gpu fused with the ops consuming the images.
+    """
+    dtype = prec.global_policy().compute_dtype
+    obs = obs.copy()
+    rgb_img_name = config.camera_names + '_image'
+    obs[rgb_img_name] = tf.cast(obs[rgb_img_name], dtype) * (1.0 / 255.0) - 0.5
+    if config.use_depth_obs == True:
+        depth_img_name = config.camera_names + '_depth'
+        # scaled in float32, the uint16 range exceeds float16 precision
+        obs[depth_img_name] = tf.cast(tf.cast(obs[depth_img_name], tf.float32) * (1.0 / 65535.0) - 0.5, dtype)
+    return obs
+
+
 def count_steps(datadir, config):
     return tools.count_episodes(datadir)[1] * config.action_repeat
 
 
-def load_dataset(directory, config):
-    # print("This should be expert directory:", directory)
-    episode = next(tools.load_episodes(directory, 1, config=config))
-    # print("Episode:", episode)
-    # for k, v in episode.items():
-    #     # print(k, ":", v.shape)
-    #     if v.dtype == 'float64':
-    #         episode[k] = v.astype('float32')
+def load_step_count(logdir, datadir, config):
+    """
+    Step count saved next to variables.pkl by `save_step_count`. The datadir is only scanned when there is none, i.e. on a fresh run.
+    """
+    filename = logdir / 'step_count.json'
+    if filename.exists():
+        return json.loads(filename.read_text())['step']
+    return count_steps(datadir, config)
+
+
+def save_step_count(logdir, step):
+    # written to a temporary file and renamed, so that a resumed run never reads a partial file
+    filename = logdir / 'step_count.json.tmp'
+    filename.write_text(json.dumps({'step': int(step)}))
+    filename.replace(logdir / 'step_count.json')
+
+
+def load_dataset(cache, config, device=None):
+    """
+    Infinite dataset of batches sampled in the graph from the episodes of a `tools.EpisodeCache`, 
+    new episodes become part of it once `cache.update()` has loaded them. 
+    device: if given, batches are prefetched into that device's memory. Leave it unset for datasets 
+    handed to `experimental_distribute_dataset`, whose iterator already stages batches on each replica.
+    """
+    dataset = tf.data.Dataset.from_tensors(0).repeat()
+    dataset = dataset.map(lambda _: cache.sample(config.batch_size, config.batch_length, config.dataset_balance), 
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.map(functools.partial(preprocess, config=config), num_parallel_calls=tf.data.AUTOTUNE)
     
-    types = {k: v.dtype for k, v in episode.items()}
-    shapes = {k: (None,) + v.shape[1:] for k, v in episode.items()}
-    generator = lambda: tools.load_episodes(directory, config.train_steps, config.batch_length, config.dataset_balance, config=config)
-    dataset = tf.data.Dataset.from_generator(generator, types, shapes)
+    options = tf.data.Options()
+    options.deterministic = False
+    dataset = dataset.with_options(options)
+    
+    if device:
+        dataset = dataset.apply(tf.data.experimental.prefetch_to_device(device, buffer_size=tf.data.AUTOTUNE))
+    else:
+        dataset = dataset.prefetch(10)
+    return dataset
+
+
+def load_expert_cache(directory, config):
+    """
+    Loads all the expert episodes once and stacks them into non-trainable variables of shape [episodes, length, ...], 
+    zero-padded to the longest episode. Also returns the length of every episode, segments are only sampled within it.
+    """
+    directory = pathlib.Path(directory).expanduser()
+    keys = tools.relevant_keys(config)
+    episodes = [tools.load_episode(filename, keys) for filename in sorted(directory.glob('*.npz'))]
+    # like `tools.load_episodes`, episodes too short for a segment are skipped
+    episodes = [episode for episode in episodes if len(episode['action']) > config.batch_length]
+    assert episodes, f'No expert episodes longer than {config.batch_length} steps found in {directory}.'
+    lengths = np.array([len(episode['action']) for episode in episodes], np.int64)
+    
+    pad = lambda v: np.concatenate([v, np.zeros((lengths.max() - len(v),) + v.shape[1:], v.dtype)])
+    data = preprocess({k: np.stack([pad(episode[k]) for episode in episodes]) for k in episodes[0]}, config)
+    cache = {k: tf.Variable(v, trainable=False) for k, v in data.items()}
+    print(f'Cached {len(episodes)} expert episodes of length {lengths.min()} to {lengths.max()}.')
+    return cache, lengths
+
+
+def load_expert_indices(lengths, config):
+    """
+    Infinite dataset of batched (episode, start) indices into the expert cache, sampled like `tools.load_episodes` 
+    within the length `lengths[episode]` of each episode.
+    """
+    num_episodes = len(lengths)
+    lengths = tf.constant(lengths, tf.int64)
+    available = lengths - config.batch_length
+    
+    def sample_start(episode, x):
+        if config.dataset_balance:
+            return episode, tf.minimum(x % lengths[episode], available[episode])
+        return episode, x % available[episode]
+    
+    episode = tf.data.Dataset.random(seed=config.seed).map(lambda x: x % num_episodes)
+    dataset = tf.data.Dataset.zip((episode, tf.data.Dataset.random(seed=config.seed + 1))).map(sample_start)
     dataset = dataset.batch(config.batch_size, drop_remainder=True)
-    dataset = dataset.map(functools.partial(preprocess, config=config))
     dataset = dataset.prefetch(10)
     return dataset
 
@@ -612,10 +866,14 @@ def summarize_episode(episode, config, datadir, writer, prefix):
     print(f'{prefix.title()} episode of length {length} with return {ret:.1f}.')
     
     metrics = [(f'{prefix}/return', float(episode['reward'].sum())), (f'{prefix}/length', len(episode['reward']) - 1), (f'episodes', episodes)]
-    step = count_steps(datadir, config)
+    step = steps * config.action_repeat    # same as count_steps(datadir, config), without scanning the directory again
     
-    with (config.logdir / 'metrics.jsonl').open('a') as f:
-        f.write(json.dumps(dict([('step', step)] + metrics)) + '\n')
+    if multiprocessing.parent_process() is None:
+        jsonl_writer(config.logdir / 'metrics.jsonl').put(dict([('step', step)] + metrics))
+    else:
+        # env workers of the 'process' strategy exit through os._exit without running the atexit drain, so they append synchronously
+        with (config.logdir / 'metrics.jsonl').open('a') as f:
+            f.write(json.dumps(dict([('step', step)] + metrics)) + '\n')
     
     with writer.as_default():    # Env might run in a different thread.
         tf.summary.experimental.set_step(step)
@@ -658,7 +916,8 @@ def make_env(config, writer, prefix, model_datadir, policy_datadir, store):
         callbacks.append(lambda ep: tools.save_episodes(policy_datadir, [ep]))
     callbacks.append(lambda ep: summarize_episode(ep, config, policy_datadir, writer, prefix))
     
-    env = wrappers.Collect(env, callbacks, config.precision)
+    # episodes are stored at 32 bits whatever the compute precision, so the replay format matches the expert data
+    env = wrappers.Collect(env, callbacks, 32)
     env = wrappers.RewardObs(env)
 
     return env
@@ -742,12 +1001,12 @@ def main(config):
     prefill = max(0, config.prefill - step)        # why prefill is max of 0 and (1000-16000=-15000) ?
     print(f'Prefill dataset with {prefill} steps.')
     
-    random_agent = lambda o, d, _: ([actspace.sample() for _ in d], None)
+    random_agent = tools.RandomAgent(actspace, seed=config.seed)
     tools.simulate(random_agent, train_envs, prefill / config.action_repeat)
     tf_writer.flush()
 
-    # Train and Evaluate the agent at regular intervals
-    step = count_steps(policy_datadir, config)
+    # Train and Evaluate the agent at regular intervals, the steps are counted from disk only once, then accumulated
+    step = load_step_count(config.logdir, policy_datadir, config)
     print(f'Simulating agent for {config.steps - step} steps.')
     agent = VMAIL(config, model_datadir, policy_datadir, expert_datadir, actspace, tf_writer)
     print('Agent Created !!!')
@@ -770,13 +1029,14 @@ def main(config):
         
         print('Start data collection.')
         # collects data by simulating the agent in train_envs
-    #     state = tools.simulate(agent, train_envs, steps_to_simulate, state=state)
+    #     new_steps, state = tools.simulate(agent, train_envs, steps_to_simulate, state=state)
 
-    #     # update the step by counting steps from data collected in policy_datadir
-    #     step = count_steps(policy_datadir, config)
+    #     # update the step by the steps collected in this round, rather than rescanning policy_datadir
+    #     step += new_steps * config.action_repeat
 
-    #     # save agent's state
+    #     # save agent's state, and the step count to resume from
     #     agent.save(config.logdir / 'variables.pkl')
+    #     save_step_count(config.logdir, step)
 
     #     break
     
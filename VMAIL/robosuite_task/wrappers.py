@@ -1,4 +1,5 @@
 import atexit
+import copy
 import functools
 import sys
 import threading
@@ -10,6 +11,20 @@ import matplotlib.pyplot as plt
 from PIL import Image
 
 
+@functools.lru_cache(maxsize=None)
+def _load_controller_config(name):
+    from robosuite.controllers import load_controller_config
+    return load_controller_config(default_controller=name)
+
+
+def load_controller_config(name):
+    """
+    Default robosuite controller config `name`. The json file is parsed once per process 
+    and every env gets its own copy, so that the train and test envs don't re-read it.
+    """
+    return copy.deepcopy(_load_controller_config(name))
+
+
 class RobosuiteTask:
     def __init__(self, task, horizon=1000, size=(84, 84), camview="agentview", use_camera_obs=True, use_depth_obs=False, use_object_obs=True, use_touch_obs=True, use_tactile_obs=False, use_shape_obs=False):
         self._size = size
@@ -24,14 +39,13 @@ class RobosuiteTask:
 
         import robosuite as suite
         from robosuite.wrappers import GymWrapper
-        from robosuite.controllers import load_controller_config
         import robosuite.macros as macros
 
         # Set the image convention to opencv so that the images are automatically rendered "right side up" when using imageio (which uses opencv convention)
         macros.IMAGE_CONVENTION = "opencv"
         
         # load default controller parameters for Operational Space Control (OSC)
-        controller_config = load_controller_config(default_controller="OSC_POSE")
+        controller_config = load_controller_config("OSC_POSE")
 
         # create a robosuite environment to visualize on-screen
         self._env = suite.make(
@@ -51,7 +65,8 @@ class RobosuiteTask:
                 camera_heights=self._size[0], 
                 camera_widths=self._size[1], 
                 use_tactile_obs=self._use_tactile_obs,
-                use_touch_obs=self._use_touch_obs
+                use_touch_obs=self._use_touch_obs,
+                hard_reset=False,    # reset() keeps the compiled MuJoCo model and only resets the sim state
         )
 
     @property
@@ -220,7 +235,7 @@ class Collect:
         self._env = env
         self._callbacks = callbacks or ()
         self._precision = precision
-        self._episode = None
+        self._episode = EpisodeBuffer()
 
     def __getattr__(self, name):
         return getattr(self._env, name)
@@ -229,13 +244,12 @@ class Collect:
         obs, reward, done, info = self._env.step(action)
         obs = {k: self._convert(v) for k, v in obs.items()}
         transition = obs.copy()
-        transition['action'] = action
-        transition['reward'] = reward
+        transition['action'] = self._convert(action)
+        transition['reward'] = self._convert(reward)
         # transition['discount'] = info.get('discount', np.array(1 - float(done)))
-        self._episode.append(transition)
+        self._episode.add(transition)
         if done:
-            episode = {k: [t[k] for t in self._episode] for k in self._episode[0]}
-            episode = {k: self._convert(v) for k, v in episode.items()}
+            episode = self._episode.episode()
             info['episode'] = episode
             for callback in self._callbacks:
                 callback(episode)
@@ -243,11 +257,12 @@ class Collect:
 
     def reset(self):
         obs = self._env.reset()
-        transition = obs.copy()
-        transition['action'] = np.zeros(self._env.action_space.shape)
-        transition['reward'] = 0.0
+        transition = {k: self._convert(v) for k, v in obs.items()}
+        transition['action'] = self._convert(np.zeros(self._env.action_space.shape))
+        transition['reward'] = self._convert(0.0)
         # transition['discount'] = 1.0
-        self._episode = [transition]
+        self._episode.clear()
+        self._episode.add(transition)
         return obs
 
     def _convert(self, value):
@@ -263,6 +278,36 @@ class Collect:
         return value.astype(dtype)
 
 
+class EpisodeBuffer:
+    """
+    Per-key arrays the transitions of an episode are written into. They are allocated from the 
+    first transition, doubled when full and reused by the following episodes, instead of 
+    keeping a list of transitions and stacking it at the end of every episode.
+    """
+
+    def __init__(self, capacity=1000):
+        self._capacity = capacity
+        self._arrays = {}
+        self._length = 0
+
+    def clear(self):
+        self._length = 0
+
+    def add(self, transition):
+        if self._arrays and self._length == self._capacity:
+            self._capacity *= 2
+            self._arrays = {k: np.concatenate([v, np.empty_like(v)]) for k, v in self._arrays.items()}
+        for k, v in transition.items():
+            if k not in self._arrays:
+                self._arrays[k] = np.empty((self._capacity,) + v.shape, v.dtype)
+            self._arrays[k][self._length] = v
+        self._length += 1
+
+    def episode(self):
+        # copies of the filled rows, since the arrays are overwritten by the next episode
+        return {k: v[:self._length].copy() for k, v in self._arrays.items()}
+
+
 class TimeLimit:
     def __init__(self, env, duration):
         self._env = env
@@ -540,3 +585,4 @@ class Async:
             print(f'Error in environment process: {stacktrace}')
             conn.send((self._EXCEPTION, stacktrace))
         conn.close()
+
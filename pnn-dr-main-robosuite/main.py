@@ -80,7 +80,9 @@ if __name__ == "__main__":
 
     args.non_rgb_state_size = 0
     set_seed_everywhere(args.seed)
-    mp.set_start_method("spawn")
+    # Workers are forked from a server process that has imported this module (torch, robosuite) once, 
+    # instead of re-importing everything per worker as with spawn. The server never initialises CUDA
+    mp.set_start_method("forkserver")
     T = Counter()     # Global shared counter
 
     # Results directory
@@ -75,7 +75,7 @@ def test(rank, args, T, shared_model, device):
                     # Reset or pass on hidden state
                     if done:
                         model.load_state_dict(shared_model.state_dict())     # Sync with shared model every episode
-                        with torch.no_grad():
+                        with torch.inference_mode():
                             hx = torch.zeros(1, args.hidden_size, device=device)      # LSTM hidden state
                             cx = torch.zeros(1, args.hidden_size, device=device)      # LSTM cell state
                         
@@ -91,7 +91,7 @@ def test(rank, args, T, shared_model, device):
                         episode_reward = 0
 
                     # Calculate policy
-                    with torch.no_grad():
+                    with torch.inference_mode():
                         policy, _, (hx, cx) = model(state, (hx.detach(), cx.detach()))    # Break graph for memory efficiency
 
                     # Choose action greedily
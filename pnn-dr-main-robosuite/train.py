@@ -7,7 +7,7 @@ from torch.autograd import Variable
 # from irb120 import IRB120Env
 from Panda import RobosuiteEnv
 from model import ActorCritic
-from utils import state_to_tensor, set_seed_everywhere
+from utils import state_to_tensor, set_seed_everywhere, discounted_returns
 
 
 def _transfer_grads_to_shared_model(model, shared_model):
@@ -82,28 +82,30 @@ def _train(args, T, model, shared_model, optimiser, policies, Vs, actions, rewar
         loss_values (list):list of loss values.
     """
     # print("Inside _train:", model.device, shared_model.device, policies[0].device, actions[0,0].device)
-    policy_loss, value_loss = 0, 0
+    policy_loss = 0
+    t = len(rewards)
+    values = torch.cat(Vs)    # (t + 1, 1), the last one is R
     
-    # Generalised advantage estimator Ψ
-    A_GAE = torch.zeros(1, 1, device=device)
+    # Calculate n-step returns and generalised advantage estimates Ψ in a single compiled backward pass,
+    # neither needs gradients
+    returns, A_GAE = discounted_returns(
+        np.asarray(rewards, dtype=np.float32), 
+        values.detach().cpu().numpy().ravel().astype(np.float32), 
+        args.discount, 
+        args.trace_decay,
+    )
+    returns = torch.from_numpy(returns).unsqueeze(1).to(device)
+    A_GAE = torch.from_numpy(A_GAE).unsqueeze(1).to(device)
     
-    # Calculate n-step returns in forward view, stepping backwards from the last state
-    t = len(rewards)
-    for i in reversed(range(t)):
-        R = rewards[i] + args.discount * R    # R ← r_i + γR
-        A = R - Vs[i]    # Advantage A ← R - V(s_i; θ)
-        
-        # dθ ← dθ - ∂A^2/∂θ
-        value_loss += 0.5 * A**2  # Least squares error
-        td_error = rewards[i] + args.discount * Vs[i + 1].data - Vs[i].data    # TD residual δ = r + γV(s_i+1; θ) - V(s_i; θ)
-        
-        # Generalised advantage estimator Ψ (roughly of form ∑(γλ)^t∙δ)
-        A_GAE = A_GAE * args.discount * args.trace_decay + td_error
-        
-        # dθ ← dθ - ∇θ∙log(π(a_i|s_i; θ))∙Ψ - β∙∇θH(π(s_i; θ))
-        for j, p in enumerate(policies[i]):
-            policy_loss -= p.gather(1, actions[i][j].detach().unsqueeze(0).unsqueeze(0).to(device)).log() * Variable(A_GAE)
-            policy_loss -= args.entropy_weight * -(p.log() * p).sum(1)
+    # dθ ← dθ - ∂A^2/∂θ, with advantage A ← R - V(s_i; θ)
+    value_loss = (0.5 * (returns - values[:-1])**2).sum()  # Least squares error
+    
+    # dθ ← dθ - ∇θ∙log(π(a_i|s_i; θ))∙Ψ - β∙∇θH(π(s_i; θ)), over all time steps at once for every action dimension j
+    for j in range(len(policies[0])):
+        p = torch.cat([policy[j] for policy in policies])    # (t, n_j)
+        a = torch.stack([action[j] for action in actions]).detach().unsqueeze(1).to(device)    # (t, 1)
+        policy_loss -= (p.gather(1, a).log() * A_GAE).sum()
+        policy_loss -= args.entropy_weight * -(p.log() * p).sum()
     
     # Optionally normalise loss by number of time steps
     if not args.no_time_normalisation:
@@ -176,7 +178,7 @@ def train(rank, args, T, shared_model, optimiser, device):
             action = [p.multinomial(num_samples=1).data[0] for p in policy]
             # state, reward, done = env.step(action, episode_length)    # Step into the environment
             # print("Action before step:", action)
-            action = np.array(torch.stack(action).squeeze().cpu())
+            action = torch.stack(action).squeeze().cpu().numpy()    # shares the tensor memory, no copy
             # print("Action after:", action)
 
             state, reward, done = env.step(action)   # step into the env and collect reward
@@ -189,13 +191,14 @@ def train(rank, args, T, shared_model, optimiser, device):
             [
                 arr.append(el)
                 for arr, el in zip(
-                    (policies, Vs, actions, rewards), (policy, V, Variable(torch.LongTensor(action)), reward)
+                    (policies, Vs, actions, rewards), (policy, V, Variable(torch.as_tensor(action, dtype=torch.long)), reward)
                 )
             ]
 
-            # Increment counters
+            # Increment counter
             t += 1
-            T.increment()
+
+        T.increment(t - t_start)    # Add the rollout's steps to the global counter at once
 
         # Break graph for last values calculated (used for targets, not directly as model outputs)
         if done:
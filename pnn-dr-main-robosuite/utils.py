@@ -2,6 +2,7 @@
 import os
 import plotly
 from plotly.graph_objs import Scatter, Line
+import numba
 import numpy as np
 import torch
 from torch import multiprocessing as mp
@@ -12,25 +13,29 @@ class Counter:
         """
         Class constructor.
         """
-        self.val = mp.Value("i", 0)
+        # Unsynchronised shared int64, only increments take the lock
+        self.val = mp.Value("q", 0, lock=False)
         self.lock = mp.Lock()
 
-    def increment(self):
+    def increment(self, n=1):
         """
-        Increments in one unit the counter value.
+        Increments the counter value, by one unit unless several are added at once.
+
+        Args:
+            n (int): number of units to add.
         """
         with self.lock:
-            self.val.value += 1
+            self.val.value += n
 
     def value(self):
         """
-        Obtain the counter value.
+        Obtain the counter value. Reads don't take the lock, reading an aligned
+        64-bit value is atomic.
 
         Returns:
             int: counter value.
         """
-        with self.lock:
-            return self.val.value
+        return self.val.value
 
 
 def state_to_tensor(state, device):
@@ -49,7 +54,7 @@ def state_to_tensor(state, device):
     #     (torch.from_numpy(state[1].copy())).permute(2, 1, 0).float().div_(255).unsqueeze(0),
     # )
 
-    return torch.from_numpy(state.copy()).permute(2, 1, 0).float().div_(255).unsqueeze(0).to(device)
+    return states_to_tensor(state[None], device)
 
     # print("Before:", state.shape, state.dtype, state.min(), state.max())
     # tmp1 = torch.from_numpy(state.copy())
@@ -65,6 +70,60 @@ def state_to_tensor(state, device):
     # return tmp5
 
 
+def states_to_tensor(states, device):
+    """
+    Converts the image observations of several environments to a single batch tensor,
+    so that they are transferred and cast in one go instead of once per environment.
+
+    Args:
+        states (list or np.ndarray): (H, W, C) uint8 images, or an (N, H, W, C) array of them.
+        device (torch.device): device the batch is moved to.
+
+    Returns:
+        torch.Tensor: (N, C, H, W) float tensor with values in [0, 1].
+    """
+    if not isinstance(states, np.ndarray):
+        states = np.stack(states)    # a single copy into one contiguous buffer
+    elif any(stride < 0 for stride in states.strides):
+        # Only flipped images (negative strides) have to be copied, torch can't wrap those
+        states = np.ascontiguousarray(states)
+    # Pixels are moved as uint8, a quarter of the bytes of float32, and cast and scaled on the device.
+    # The NHWC -> NCHW permute is only a view, the cast lays the batch out as contiguous NCHW in the
+    # same pass, which the model's flattening view after the convs relies on
+    states = torch.from_numpy(states).permute(0, 3, 1, 2).to(device, non_blocking=True)
+    return states.to(torch.float32, memory_format=torch.contiguous_format).mul_(1.0 / 255)
+
+
+@numba.njit("UniTuple(float32[:], 2)(float32[:], float32[:], float64, float64)", cache=True)
+def discounted_returns(rewards, values, discount, trace_decay):
+    """
+    Calculates the n-step returns and the generalised advantage estimates of a rollout,
+    stepping backwards from the last state. Compiled when the module is imported (the
+    signature is given), so the first update doesn't pay for it.
+
+    Args:
+        rewards (np.ndarray): (t,) rewards obtained during the rollout.
+        values (np.ndarray): (t + 1,) state values, the last one bootstraps the returns.
+        discount (float): discount factor γ.
+        trace_decay (float): GAE trace decay λ.
+
+    Returns:
+        tuple: (t,) returns and (t,) advantages.
+    """
+    t = rewards.shape[0]
+    returns = np.empty(t, dtype=np.float32)
+    advantages = np.empty(t, dtype=np.float32)
+    R = values[t]
+    A_GAE = 0.0
+    for i in range(t - 1, -1, -1):
+        R = rewards[i] + discount * R    # R ← r_i + γR
+        td_error = rewards[i] + discount * values[i + 1] - values[i]    # TD residual δ = r + γV(s_i+1; θ) - V(s_i; θ)
+        A_GAE = A_GAE * discount * trace_decay + td_error    # Ψ (roughly of form ∑(γλ)^t∙δ)
+        returns[i] = R
+        advantages[i] = A_GAE
+    return returns, advantages
+
+
 def plot_line(xs, ys_population):
     """
     Plots min, max and mean + standard deviation bars of a population over time.
@@ -77,24 +136,24 @@ def plot_line(xs, ys_population):
     mean_colour = "rgb(0, 172, 237)"
     std_colour = "rgba(29, 202, 255, 0.2)"
 
-    ys = torch.Tensor(ys_population)
-    ys_min = ys.min(1)[0].squeeze()
-    ys_max = ys.max(1)[0].squeeze()
-    ys_mean = ys.mean(1).squeeze()
-    ys_std = ys.std(1).squeeze()
+    ys = np.asarray(ys_population, dtype=np.float32)
+    ys_min = ys.min(1)
+    ys_max = ys.max(1)
+    ys_mean = ys.mean(1)
+    ys_std = ys.std(1, ddof=1)    # unbiased, as torch.std
     ys_upper, ys_lower = ys_mean + ys_std, ys_mean - ys_std
 
-    trace_max = Scatter(x=xs, y=ys_max.numpy(), line=Line(color=max_colour, dash="dash"), name="Max")
+    trace_max = Scatter(x=xs, y=ys_max, line=Line(color=max_colour, dash="dash"), name="Max")
     trace_upper = Scatter(
         x=xs,
-        y=ys_upper.numpy(),
+        y=ys_upper,
         line=Line(color="transparent"),
         name="+1 Std. Dev.",
         showlegend=False,  # transparent
     )
     trace_mean = Scatter(
         x=xs,
-        y=ys_mean.numpy(),
+        y=ys_mean,
         fill="tonexty",
         fillcolor=std_colour,
         line=Line(color=mean_colour),
@@ -102,14 +161,14 @@ def plot_line(xs, ys_population):
     )
     trace_lower = Scatter(
         x=xs,
-        y=ys_lower.numpy(),
+        y=ys_lower,
         fill="tonexty",
         fillcolor=std_colour,
         line=Line(color="transparent"),  # transparent
         name="-1 Std. Dev.",
         showlegend=False,
     )
-    trace_min = Scatter(x=xs, y=ys_min.numpy(), line=Line(color=max_colour, dash="dash"), name="Min")
+    trace_min = Scatter(x=xs, y=ys_min, line=Line(color=max_colour, dash="dash"), name="Min")
 
     plotly.offline.plot(
         {
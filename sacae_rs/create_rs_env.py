@@ -9,6 +9,7 @@ import math
 import matplotlib.pyplot as plt
 import imageio
 import pprint
+from concurrent.futures import ThreadPoolExecutor
 
 import robosuite as suite
 from robosuite.controllers import load_controller_config
@@ -78,8 +79,9 @@ def get_policy_action(obs=None):
 
 env2 = GymWrapper(env)
 
-frames_rgb = []
-frames_depth = []
+# frame buffers for the whole episode (reset frame + horizon steps), allocated once and written in place
+frames_rgb = np.empty((horizon + 1, image_size, image_size, 3), dtype=np.uint8)
+frames_depth = np.empty((horizon + 1, image_size, image_size), dtype=np.uint8)
 obs = env2.reset()
 # print(obs.shape, obs[:image_size*image_size*3].min(), obs[:image_size*image_size*3].max(), obs[image_size*image_size*3:].min(), obs[image_size*image_size*3:].max())
 # print(obs.shape, obs[:image_size*image_size*3].min(), obs[:image_size*image_size*3].max(), obs[image_size*image_size*3:image_size*image_size*4].min(), obs[image_size*image_size*3:image_size*image_size*4].max(), obs[image_size*image_size*4:].min(), obs[image_size*image_size*4:].max())
@@ -87,18 +89,19 @@ obs = env2.reset()
 rgb_dim = image_size * image_size * 3
 depth_dim = image_size * image_size if env.camera_depths[0] == True else 0
 
+def decode_image(obs, offset, channels):
+    # vertically flipped view of an image in the flat observation, nothing is copied until 
+    # it is assigned into a uint8 frame buffer, which casts it in the same pass
+    return obs[offset:offset + image_size * image_size * channels].reshape(image_size, image_size, channels)[::-1]
+
 rgb_obs = np.flip(obs[:rgb_dim].reshape(image_size, image_size, 3), axis=0)
 if depth_dim > 0:
     depth_obs = np.flip(obs[rgb_dim:rgb_dim+depth_dim].reshape(image_size, image_size, 1), axis=0)
     rgb_obs = np.concatenate([rgb_obs, depth_obs], axis=2)
 
 print(rgb_obs[:,:,0].min(), rgb_obs[:,:,0].max(), rgb_obs[:,:,1].min(), rgb_obs[:,:,1].max(), rgb_obs[:,:,2].min(), rgb_obs[:,:,2].max(), rgb_obs[:,:,3].min(), rgb_obs[:,:,3].max())
-rgb_obs = rgb_obs.astype(np.uint8)
-frames_rgb.append(rgb_obs)
-
-obs2 = 255.0 - np.flip(obs[image_size*image_size*3:image_size*image_size*4].reshape(image_size, image_size), axis=0) * 255.0
-obs2 = obs2.astype(np.uint8)
-frames_depth.append(obs2)
+frames_rgb[0] = decode_image(obs, 0, 3)
+frames_depth[0] = 255.0 - decode_image(obs, rgb_dim, 1)[:, :, 0] * 255.0
 
 done = False
 ret = 0.
@@ -111,23 +114,20 @@ while not done:
     obs, reward, done, _ = env2.step(action) # play action
     ret += reward
     
-    obs1 = np.flip(obs[:image_size*image_size*3].reshape(image_size, image_size, 3), axis=0)
-    obs1 = obs1.astype(np.uint8)
-    frames_rgb.append(obs1)
-
-    obs2 = 255.0 - np.flip(obs[image_size*image_size*3:image_size*image_size*4].reshape(image_size, image_size), axis=0) * 255.0
-    obs2 = obs2.astype(np.uint8)
-    frames_depth.append(obs2)
+    frames_rgb[i + 1] = decode_image(obs, 0, 3)
+    frames_depth[i + 1] = 255.0 - decode_image(obs, rgb_dim, 1)[:, :, 0] * 255.0
     i += 1
 
 print("rollout completed with return {}".format(ret))
 print(f"Spend {time.time() - start_time:.3f} s to run 1000 steps")
 
-path = "images/view_rgb.mp4"
-imageio.mimsave(path, frames_rgb, fps=90)
-
-path = "images/view_depth.mp4"
-imageio.mimsave(path, frames_depth, fps=90)
+# encode both videos in background threads (ffmpeg releases the GIL) while the envs shut down;
+# macro_block_size=1 keeps the 84x84 frames from being resized to a multiple of 16
+video_writer = ThreadPoolExecutor(max_workers=2)
+videos = [
+    video_writer.submit(imageio.mimsave, "images/view_rgb.mp4", frames_rgb[:i + 1], fps=90, macro_block_size=1),
+    video_writer.submit(imageio.mimsave, "images/view_depth.mp4", frames_depth[:i + 1], fps=90, macro_block_size=1),
+]
 
 # find the difference between the two set of frames
 # for i in range(horizon):
@@ -137,6 +137,9 @@ imageio.mimsave(path, frames_depth, fps=90)
 
 env.close()
 env2.close()
+for video in videos:
+    video.result()
+video_writer.shutdown()
 
 # Get the camera object
 # camera = env.sim